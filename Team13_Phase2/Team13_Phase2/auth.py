@@ -0,0 +1,98 @@
+# auth.py
+# Optional packet authentication for TinyTelemetry.
+# A signed packet is the normal packet followed by a TAG_SIZE-byte trailer:
+#   tag = BLAKE2s(key=device_key, digest_size=TAG_SIZE)(header + payload)
+# Each device_key is derived from one master secret, so the server needs no
+# key table: device_key = BLAKE2s(key=secret, person=KEY_PERSON)(device_id).
+# Only the server holds the secret; a device is provisioned with its own
+# device_key, so it cannot sign for any other device_id.
+#
+# provisioning:
+#   python auth.py --secret S --first 101 --count 50 > keys.json
+
+import hashlib
+import hmac
+import struct
+import json
+import argparse
+
+TAG_SIZE = 8              # truncated tag bytes appended to each packet
+KEY_PERSON = b"TTdevkey"  # BLAKE2s personalization for key derivation (max 8 bytes)
+
+def _master(secret):
+    if isinstance(secret, str):
+        secret = secret.encode()
+    if not secret:
+        raise ValueError("auth secret must not be empty")
+    return hashlib.blake2s(secret).digest() if len(secret) > 32 else secret
+
+def derive_key(secret, device_id):
+    """The device_key a device is provisioned with (server side only)."""
+    return hashlib.blake2s(struct.pack("!H", device_id & 0xFFFF), key=_master(secret), person=KEY_PERSON).digest()
+
+def load_device_keys(path):
+    """{device_id: device_key} from a JSON file of {"101": "<hex key>", ...}."""
+    with open(path) as f:
+        return {int(d) & 0xFFFF: bytes.fromhex(k) for d, k in json.load(f).items()}
+
+class PacketAuth:
+    """
+    Signs and verifies packets. A keyed BLAKE2s object is built once per
+    device and cached; each packet copy()s it, which skips re-keying.
+    PacketAuth(secret) derives any device's key (the server);
+    PacketAuth.for_devices(keys) knows only the given devices' keys (clients).
+    """
+    def __init__(self, secret):
+        self.secret = _master(secret)
+        self._hashers = {}   # device_id -> keyed blake2s object
+
+    @classmethod
+    def for_devices(cls, keys):
+        """Client-side auth from {device_id: device_key}; no master secret."""
+        auth = cls.__new__(cls)
+        auth.secret = None
+        auth._hashers = {d & 0xFFFF: hashlib.blake2s(key=k, digest_size=TAG_SIZE) for d, k in keys.items()}
+        return auth
+
+    def _hasher(self, device_id):
+        h = self._hashers.get(device_id)
+        if h is None:
+            if self.secret is None:
+                return None
+            key = derive_key(self.secret, device_id)
+            h = self._hashers[device_id] = hashlib.blake2s(key=key, digest_size=TAG_SIZE)
+        return h
+
+    def tag(self, device_id, data):
+        h = self._hasher(device_id)
+        if h is None:
+            return None
+        h = h.copy()
+        h.update(data)
+        return h.digest()
+
+    def sign(self, device_id, packet):
+        tag = self.tag(device_id & 0xFFFF, packet)
+        if tag is None:
+            raise ValueError(f"no key for device {device_id & 0xFFFF}")
+        return packet + tag
+
+    def verify(self, data):
+        """Returns the packet without its tag, or None if the tag is missing or wrong."""
+        if len(data) < 2 + TAG_SIZE:
+            return None
+        body, tag = data[:-TAG_SIZE], data[-TAG_SIZE:]
+        device_id = struct.unpack_from("!H", body)[0]
+        expected = self.tag(device_id, body)
+        if expected is None or not hmac.compare_digest(expected, tag):
+            return None
+        return body
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Derive per-device keys for signed TinyTelemetry packets")
+    parser.add_argument("--secret", type=str, required=True, help="Master secret (the server's --auth-secret)")
+    parser.add_argument("--first", type=int, default=101, help="First device_id")
+    parser.add_argument("--count", type=int, default=1, help="Number of consecutive device_ids")
+    args = parser.parse_args()
+    print(json.dumps({str(d): derive_key(args.secret, d).hex()
+                      for d in range(args.first, args.first + args.count)}, indent=2))
@@ -0,0 +1,52 @@
+#!/usr/bin/env python3
+# bench_auth.py
+# Per-packet cost of signing/verifying (auth.py) at batch 1 and batch 255.
+# Exits non-zero if verification exceeds BUDGET_US per packet.
+import time
+import random
+import argparse
+import sys
+
+from protocol import build_packet, DATA
+from auth import PacketAuth
+
+BUDGET_US = 10.0     # allowed verify cost per packet (microseconds)
+DEVICES = 1000       # distinct device_ids, so the per-device key cache is exercised
+
+def bench(batch, packets):
+    auth = PacketAuth("bench-secret")
+    devices = [random.randint(0, 0xFFFF) for _ in range(DEVICES)]
+    readings = [round(random.uniform(20, 30), 2) for _ in range(batch)]
+    raw = [(d, build_packet(d, i, DATA, readings)) for i, d in enumerate(devices)]
+
+    # warm the per-device key cache, as a long-running server would be
+    signed = [auth.sign(d, pkt) for d, pkt in raw]
+
+    t0 = time.perf_counter()
+    for i in range(packets):
+        d, pkt = raw[i % DEVICES]
+        auth.sign(d, pkt)
+    sign_us = (time.perf_counter() - t0) / packets * 1e6
+
+    t0 = time.perf_counter()
+    for i in range(packets):
+        if auth.verify(signed[i % DEVICES]) is None:
+            raise RuntimeError("verification failed")
+    verify_us = (time.perf_counter() - t0) / packets * 1e6
+
+    return sign_us, verify_us, len(signed[0])
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Benchmark TinyTelemetry packet authentication")
+    parser.add_argument("--packets", type=int, default=200000, help="Packets per measurement")
+    parser.add_argument("--budget", type=float, default=BUDGET_US, help="Verify budget per packet (us)")
+    args = parser.parse_args()
+
+    ok = True
+    for batch in (1, 255):
+        sign_us, verify_us, size = bench(batch, args.packets)
+        within = verify_us <= args.budget
+        ok = ok and within
+        print(f"[Bench] batch={batch:3d} size={size}B sign={sign_us:.2f}us verify={verify_us:.2f}us "
+              f"per_reading={verify_us / batch:.3f}us {'OK' if within else 'OVER BUDGET'}")
+    sys.exit(0 if ok else 1)
@@ -0,0 +1,146 @@
+#!/usr/bin/env python3
+# bench_router.py
+# Forwarding throughput of router.py with several local sink collectors,
+# plus how many devices move when a backend is added or removed.
+# The router runs as its own `router.py` process and every sink in its own
+# process, so the sender, router and sinks do not share one interpreter.
+# Loss is split by where it happened: at the router's socket (sent but never
+# read by the router), inside the router (its own dropped counter) and
+# between router and sinks (forwarded but never read by a sink).
+import os
+import re
+import sys
+import time
+import signal
+import socket
+import argparse
+import subprocess
+from multiprocessing import Process, Queue, Event, Array
+
+from protocol import build_packet, parse_header, DATA
+from router import HashRing, moved_fraction
+
+PY = sys.executable
+ROUTER_SCRIPT = os.path.join(os.path.dirname(os.path.abspath(__file__)), "router.py")
+SINK_RCVBUF = 8 << 20
+IDLE_S = 0.5         # forwarding is done once no sink has received anything for this long
+READY_RE = re.compile(r"\[Router\] Listening on [\d.]+:(\d+)")
+SUMMARY_RE = re.compile(r"\[Router\] forwarded=(\d+) relayed=(\d+) dropped=(\d+)")
+
+def sink(slot, ports, progress, results, stop):
+    """One collector stand-in: reports its port, then (port, count, devices, first, last)."""
+    s = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+    s.setsockopt(socket.SOL_SOCKET, socket.SO_RCVBUF, SINK_RCVBUF)
+    s.bind(("127.0.0.1", 0))
+    s.settimeout(0.1)
+    port = s.getsockname()[1]
+    ports.put(port)
+    count, devices, first, last = 0, set(), None, None
+    while not stop.is_set():
+        try:
+            data, _ = s.recvfrom(4096)
+        except socket.timeout:
+            continue
+        last = time.time()
+        if first is None:
+            first = last
+        count += 1
+        progress[slot] = count
+        devices.add(parse_header(data)[0])
+    results.put((port, count, devices, first, last))
+
+def start_router(backends):
+    spec = ",".join(f"{h}:{p}" for h, p in backends)
+    proc = subprocess.Popen([PY, "-u", ROUTER_SCRIPT, "--port", "0", "--backends", spec],
+                            stdout=subprocess.PIPE, stderr=subprocess.STDOUT, text=True)
+    ready = READY_RE.search(proc.stdout.readline())
+    if not ready:
+        proc.kill()
+        raise RuntimeError("router did not start")
+    return proc, int(ready.group(1))
+
+def stop_router(proc):
+    """SIGTERM the router and return its own (forwarded, relayed, dropped) counters."""
+    proc.send_signal(signal.SIGTERM)
+    out, _ = proc.communicate(timeout=5)
+    summary = SUMMARY_RE.search(out)
+    if not summary:
+        raise RuntimeError(f"no router summary in output: {out!r}")
+    return tuple(int(g) for g in summary.groups())
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Benchmark the TinyTelemetry router")
+    parser.add_argument("--backends", type=int, default=3, help="Number of sink collectors")
+    parser.add_argument("--packets", type=int, default=200000, help="Packets to send")
+    parser.add_argument("--devices", type=int, default=1000, help="Distinct device_ids")
+    parser.add_argument("--rate", type=float, default=0,
+                        help="Cap the sender at this many pkt/s (0 = unthrottled); "
+                             "a capped run measures at most this rate, not the router's limit")
+    args = parser.parse_args()
+
+    ports, results, stop = Queue(), Queue(), Event()
+    progress = Array("q", args.backends, lock=False)   # per-sink receive counts, one writer each
+    sinks = [Process(target=sink, args=(i, ports, progress, results, stop), daemon=True)
+             for i in range(args.backends)]
+    for p in sinks:
+        p.start()
+    backends = [("127.0.0.1", ports.get(timeout=5)) for _ in sinks]
+
+    # rebalance cost: share of the 65536 device_ids that change owner
+    ring = HashRing(backends)
+    grown = HashRing(backends + [("127.0.0.1", 1)])
+    shrunk = HashRing(backends[1:])
+    print(f"[Bench] add 1 backend: moved={moved_fraction(ring.table, grown.table):.3f} "
+          f"(ideal {1 / (args.backends + 1):.3f})")
+    print(f"[Bench] remove 1 backend: moved={moved_fraction(ring.table, shrunk.table):.3f} "
+          f"(ideal {1 / args.backends:.3f})")
+
+    router, router_port = start_router(backends)
+    packets = [build_packet(d, 0, DATA, [21.5]) for d in range(args.devices)]
+    out = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+    dest = ("127.0.0.1", router_port)
+    t0 = time.perf_counter()
+    for i in range(args.packets):
+        out.sendto(packets[i % args.devices], dest)
+        if args.rate and i % 256 == 255:
+            # hold the sender to --rate; this bounds the measured rate
+            ahead = (i + 1) / args.rate - (time.perf_counter() - t0)
+            if ahead > 0:
+                time.sleep(ahead)
+    send_s = time.perf_counter() - t0
+
+    # wait for the router to drain: no sink has received anything for IDLE_S
+    last_total = -1
+    while sum(progress) != last_total:
+        last_total = sum(progress)
+        time.sleep(IDLE_S)
+    forwarded, _, dropped = stop_router(router)
+    stop.set()
+    per_backend = {}
+    first, last = [], []
+    backend_of = {}
+    for _ in sinks:
+        port, count, devices, f, l = results.get(timeout=5)
+        per_backend[port] = count
+        if f is not None:
+            first.append(f)
+            last.append(l)
+        for d in devices:
+            backend_of.setdefault(d, set()).add(port)
+    for p in sinks:
+        p.join(timeout=2)
+
+    received = sum(per_backend.values())
+    router_in = forwarded + dropped
+    span = max(last) - min(first) if first else 0.0
+    split = sum(1 for owners in backend_of.values() if len(owners) > 1)
+    print(f"[Bench] sent={args.packets} in {send_s:.2f}s "
+          f"({args.packets / send_s:,.0f} pkt/s{f', capped at {args.rate:,.0f}' if args.rate else ', unthrottled'})")
+    print(f"[Bench] router read={router_in} ({router_in / args.packets:.1%}) "
+          f"forwarded={forwarded} dropped={dropped}")
+    print(f"[Bench] sinks received={received} ({received / args.packets:.1%}) "
+          f"rate={received / span if span > 0 else 0:,.0f} pkt/s")
+    print(f"[Bench] lost at router socket={args.packets - router_in} "
+          f"in router={dropped} router->sinks={forwarded - received}")
+    print(f"[Bench] per-backend packets: {dict(sorted(per_backend.items()))}")
+    print(f"[Bench] devices seen on more than one backend: {split}")
@@ -0,0 +1,178 @@
+# cache.py
+# Bounded in-memory cache of recent readings per device, kept sorted by
+# packet timestamp so range queries are two bisects and a slice.
+# Storage per device is two compact arrays: timestamps as uint32 (same as
+# the header field) and readings as float32 (same as the payload).
+
+import threading
+import collections
+import json
+from array import array
+from bisect import bisect_left, bisect_right
+
+PER_DEVICE_READINGS = 3600     # newest readings kept per device
+MAX_READINGS = 1_000_000       # global cap across all devices (~8 MB)
+IDLE_TIMEOUT = 600             # seconds without data before a device is dropped
+MAX_REPLY_BYTES = 65000        # encoded query reply must fit one UDP datagram (65507)
+VALUE_DECIMALS = 2             # clients send readings rounded to 2 decimals
+
+class DeviceReadings:
+    __slots__ = ("ts", "values", "last_seen")
+
+    def __init__(self):
+        self.ts = array('I')
+        self.values = array('f')
+        self.last_seen = 0.0
+
+class ReadingCache:
+    """
+    device_id -> DeviceReadings, in least-recently-updated order so the
+    global cap evicts idle devices first. Each device keeps at most
+    `per_device` readings; older ones are trimmed in blocks to keep
+    appends amortized O(1).
+    """
+    def __init__(self, per_device=PER_DEVICE_READINGS, max_readings=MAX_READINGS):
+        self.per_device = per_device
+        self.max_readings = max_readings
+        self.devices = collections.OrderedDict()
+        self.total = 0
+        self.lock = threading.Lock()
+
+    def add(self, device_id, timestamp, readings, now):
+        if not readings:
+            return
+        with self.lock:
+            dev = self.devices.get(device_id)
+            if dev is None:
+                dev = self.devices[device_id] = DeviceReadings()
+            else:
+                self.devices.move_to_end(device_id)
+            dev.last_seen = now
+            ts, values = dev.ts, dev.values
+
+            if not ts or timestamp >= ts[-1]:
+                ts.extend([timestamp] * len(readings))
+                values.extend(readings)
+            else:
+                # late (reordered) packet: insert at its time position
+                i = bisect_right(ts, timestamp)
+                for r in reversed(readings):
+                    ts.insert(i, timestamp)
+                    values.insert(i, r)
+            self.total += len(readings)
+
+            # trim with some slack so we don't shift the arrays on every packet
+            if len(ts) > self.per_device + self.per_device // 4:
+                self._trim(dev, len(ts) - self.per_device)
+
+            while self.total > self.max_readings and len(self.devices) > 1:
+                _, old = self.devices.popitem(last=False)
+                self.total -= len(old.ts)
+
+    def _trim(self, dev, n):
+        del dev.ts[:n]
+        del dev.values[:n]
+        self.total -= n
+
+    def evict_idle(self, now, idle_timeout=IDLE_TIMEOUT):
+        with self.lock:
+            while self.devices:
+                device_id, dev = next(iter(self.devices.items()))
+                if now - dev.last_seen <= idle_timeout:
+                    break
+                del self.devices[device_id]
+                self.total -= len(dev.ts)
+
+    def latest(self, device_id):
+        with self.lock:
+            dev = self.devices.get(device_id)
+            if dev is None or not dev.ts:
+                return None
+            return dev.ts[-1], dev.values[-1]
+
+    def range(self, device_id, start, end):
+        """Readings with start <= timestamp <= end as [(ts, value)], oldest first."""
+        with self.lock:
+            dev = self.devices.get(device_id)
+            if dev is None:
+                return []
+            lo = bisect_left(dev.ts, start)
+            hi = bisect_right(dev.ts, end)
+            return list(zip(dev.ts[lo:hi], dev.values[lo:hi]))
+
+    def query(self, request, now):
+        """
+        Answers a decoded query dict:
+          {"device_id": 101, "last": 300}              readings from the last 300 s
+          {"device_id": 101, "start": t0, "end": t1}   readings in [t0, t1]
+        Either form also returns the device's latest reading.
+        Send the result with encode_reply(), which sizes it for one datagram.
+        """
+        device_id = int(request["device_id"])
+        if "last" in request:
+            start, end = now - float(request["last"]), now
+        else:
+            start = float(request.get("start", 0))
+            end = float(request.get("end", now))
+        return {
+            "device_id": device_id,
+            "start": start,
+            "end": end,
+            "latest": self.latest(device_id),
+            "readings": self.range(device_id, start, end),
+        }
+
+def _pack(reply, readings, truncated):
+    # compact wire form: first timestamp + deltas, values rounded like the client sends them
+    ts = [t for t, _ in readings]
+    latest = reply["latest"]
+    return json.dumps({
+        "device_id": reply["device_id"],
+        "start": reply["start"],
+        "end": reply["end"],
+        "latest": [latest[0], round(latest[1], VALUE_DECIMALS)] if latest else None,
+        "t0": ts[0] if ts else None,
+        "dt": [b - a for a, b in zip(ts, ts[1:])],
+        "values": [round(v, VALUE_DECIMALS) for _, v in readings],
+        "truncated": truncated,
+    }, separators=(",", ":")).encode()
+
+def encode_reply(reply, max_bytes=MAX_REPLY_BYTES):
+    """
+    Encodes a query() result into at most max_bytes, keeping the newest
+    readings and setting "truncated" if older ones had to be dropped.
+    """
+    readings = reply["readings"]
+    data = _pack(reply, readings, False)
+    while len(data) > max_bytes and readings:
+        # shrink proportionally to the overshoot, always by at least one reading
+        keep = min(len(readings) - 1, int(len(readings) * max_bytes / len(data) * 0.95))
+        readings = readings[len(readings) - keep:] if keep > 0 else []
+        data = _pack(reply, readings, True)
+    return data
+
+def decode_readings(reply):
+    """[(ts, value)] from a decoded encode_reply() payload."""
+    if reply.get("t0") is None:
+        return []
+    ts = [reply["t0"]]
+    for d in reply["dt"]:
+        ts.append(ts[-1] + d)
+    return list(zip(ts, reply["values"]))
+
+if __name__ == "__main__":
+    # self-check: a full per-device window of worst-case readings fits one datagram untruncated
+    cache = ReadingCache()
+    now = 1_800_000_000
+    for i in range(PER_DEVICE_READINGS):
+        cache.add(1, now - 999 * (PER_DEVICE_READINGS - i), [-12345.67], now)
+    reply = cache.query({"device_id": 1, "start": 0, "end": now}, now)
+    data = encode_reply(reply)
+    decoded = json.loads(data)
+    assert len(reply["readings"]) == PER_DEVICE_READINGS
+    assert not decoded["truncated"] and len(decode_readings(decoded)) == PER_DEVICE_READINGS, len(data)
+    assert decode_readings(decoded)[-1] == (now - 999, -12345.67)
+    # and an oversized reply is cut to the newest readings and flagged
+    small = json.loads(encode_reply(reply, max_bytes=4000))
+    assert small["truncated"] and decode_readings(small)[-1] == (now - 999, -12345.67)
+    print(f"[Cache] full window of {PER_DEVICE_READINGS} readings encodes to {len(data)} bytes (limit {MAX_REPLY_BYTES})")
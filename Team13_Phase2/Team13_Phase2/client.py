@@ -5,13 +5,64 @@ import random
 import threading
 import argparse
 import sys
+import os
+import heapq
+import select
+from array import array
 
 # Import your custom protocol constants and functions
-from protocol import build_packet, DATA, HEARTBEAT
+from protocol import build_packet, parse_header, parse_nack, DATA, HEARTBEAT, NACK, HEADER_SIZE
+from auth import PacketAuth, load_device_keys
+
+DEFERRED = 0  # FleetClient event kind for packets queued by defer()
+RETX_HISTORY = 256        # sent DATA packets kept per device for retransmission
+FLEET_RETX_HISTORY = 64   # smaller per-device history in fleet mode
+NACK_LINGER = 3.5         # seconds to keep answering NACKs after the last send
+                          # (server NACKs every 1s, up to 3 times per seq)
+
+class SendHistory:
+    """Bounded ring of recently sent DATA packets, indexed by seq % size."""
+    def __init__(self, size=RETX_HISTORY):
+        self.size = size
+        self.seqs = array('q', [-1]) * size
+        self.packets = [None] * size
+
+    def add(self, seq, pkt):
+        i = seq % self.size
+        self.seqs[i] = seq
+        self.packets[i] = pkt
+
+    def get(self, seq):
+        i = seq % self.size
+        return self.packets[i] if self.seqs[i] == seq else None
+
+    def lookup(self, ranges):
+        """Yields (seq, packet) for every NACKed seq still in the ring."""
+        for first, last in ranges:
+            # anything older than one ring's worth has been overwritten
+            for seq in range(max(first, last - self.size + 1), last + 1):
+                pkt = self.get(seq)
+                if pkt is not None:
+                    yield seq, pkt
+
+def read_nack(data, auth=None):
+    """Decodes a NACK datagram into (device_id, ranges), or None if it isn't a valid one."""
+    if auth:
+        data = auth.verify(data)
+        if data is None:
+            return None
+    try:
+        device_id, _, _, msg_type, count = parse_header(data)
+        if msg_type != NACK:
+            return None
+        return device_id, parse_nack(data[HEADER_SIZE:], count)
+    except ValueError:
+        return None
 
 class SensorClient:
     def __init__(self, device_id, reporting_interval=1, heartbeat_interval=5,
-                 batch_size=1, server_ip="127.0.0.1", server_port=5555):
+                 batch_size=1, server_ip="127.0.0.1", server_port=5555, device_key=None,
+                 reliable=False):
         
         # Device configuration (Device ID must fit in uint16)
         self.device_id = int(device_id) & 0xFFFF
@@ -23,6 +74,9 @@ class SensorClient:
         self.server = (server_ip, server_port)
         self.sock = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
 
+        # Optional packet authentication with this device's own key (appends a tag to every packet)
+        self.auth = PacketAuth.for_devices({self.device_id: device_key}) if device_key else None
+
         # Sequence number (4-byte unsigned int)
         self.seq = 0
         self.running = True
@@ -31,6 +85,13 @@ class SensorClient:
         self.hb_thread = threading.Thread(target=self._heartbeat_loop, daemon=True)
         self.hb_thread.start()
 
+        # Reliability mode: keep recent DATA packets and answer server NACKs
+        self.history = SendHistory() if reliable else None
+        self.retransmits = 0
+        if reliable:
+            self.nack_thread = threading.Thread(target=self._nack_loop, daemon=True)
+            self.nack_thread.start()
+
     def _make_reading(self):
         """Generate a mock sensor reading (temperature)."""
         return round(random.uniform(20.0, 30.0), 2)
@@ -41,6 +102,11 @@ class SensorClient:
         
         # Build binary packet using protocol.py
         pkt = build_packet(self.device_id, self.seq, DATA, readings)
+        if self.auth:
+            pkt = self.auth.sign(self.device_id, pkt)
+        
+        if self.history:
+            self.history.add(self.seq, pkt)
         
         try:
             self.sock.sendto(pkt, self.server)
@@ -55,6 +121,8 @@ class SensorClient:
         """Sends a HEARTBEAT packet (no data payload)."""
         # Note: We send the current seq without incrementing it
         pkt = build_packet(self.device_id, self.seq, HEARTBEAT, [])
+        if self.auth:
+            pkt = self.auth.sign(self.device_id, pkt)
         try:
             self.sock.sendto(pkt, self.server)
             print(f"[Client {self.device_id}] sent HEARTBEAT seq={self.seq}", flush=True)
@@ -68,8 +136,34 @@ class SensorClient:
             if self.running:
                 self.send_heartbeat()
 
-    def run(self, duration=None):
-        """Main loop that sends data periodically for a set duration."""
+    def _nack_loop(self):
+        """Background loop that retransmits DATA packets the server NACKs."""
+        self.sock.settimeout(0.5)
+        while self.running:
+            try:
+                data, _ = self.sock.recvfrom(2048)
+            except socket.timeout:
+                continue
+            except OSError:
+                # socket not bound yet (nothing sent) or already closed
+                time.sleep(0.1)
+                continue
+            nack = read_nack(data, self.auth)
+            if nack is None or nack[0] != self.device_id:
+                continue
+            for seq, pkt in self.history.lookup(nack[1]):
+                try:
+                    self.sock.sendto(pkt, self.server)
+                    self.retransmits += 1
+                    print(f"[Client {self.device_id}] retransmit DATA seq={seq}", flush=True)
+                except Exception as e:
+                    print(f"[Client {self.device_id}] Retransmit Error: {e}", flush=True)
+
+    def run(self, duration=None, linger=0.0):
+        """
+        Main loop that sends data periodically for a set duration.
+        linger: seconds to keep answering NACKs after the last send.
+        """
         print(f"[Client {self.device_id}] Reporting every {self.reporting_interval}s, Batching={self.batch_size}", flush=True)
         start_time = time.time()
 
@@ -83,12 +177,209 @@ class SensorClient:
                 self.send_data()
                 time.sleep(self.reporting_interval)
 
+            if linger > 0 and self.history is not None:
+                # the NACK thread keeps retransmitting until the socket closes
+                time.sleep(linger)
+
         except KeyboardInterrupt:
             print(f"[Client {self.device_id}] Interrupted by user.", flush=True)
         finally:
             self.running = False
             self.sock.close()
 
+class FleetClient:
+    """
+    Emulates many SensorClient devices from a single thread.
+    All devices share a small pool of UDP sockets and one deadline heap
+    that drives both DATA and HEARTBEAT sends; per-device seq state lives
+    in a compact array instead of one object/thread/socket per device.
+    speed > 1 runs the scheduler on a virtual clock (e.g. speed=30 turns 30s
+    into 1s). Only intervals are virtual: packet timestamps stay real so they
+    line up with the server's arrival_time.
+    """
+    def __init__(self, device_ids, reporting_interval=1, heartbeat_interval=5,
+                 batch_size=1, server_ip="127.0.0.1", server_port=5555, sockets=4, speed=1.0,
+                 auth_keys=None, reliable=False):
+
+        # Device configuration (Device IDs must fit in uint16)
+        self.device_ids = array('H', (int(d) & 0xFFFF for d in device_ids))
+        self.reporting_interval = float(reporting_interval)
+        self.heartbeat_interval = float(heartbeat_interval)
+        self.batch_size = max(1, int(batch_size))
+        self.speed = max(1e-6, float(speed))
+
+        # Server settings: device i always uses socket i % len(socks)
+        self.server = (server_ip, server_port)
+        n_socks = max(1, min(int(sockets), len(self.device_ids)))
+        self.socks = [socket.socket(socket.AF_INET, socket.SOCK_DGRAM) for _ in range(n_socks)]
+        # auth_keys: {device_id: device_key}, one per emulated device
+        self.auth = None
+        if auth_keys:
+            unkeyed = [d for d in self.device_ids if d not in auth_keys]
+            if unkeyed:
+                raise ValueError(f"no device key for {len(unkeyed)} device(s), e.g. {unkeyed[0]}")
+            self.auth = PacketAuth.for_devices(auth_keys)
+
+        # Sequence numbers (4-byte unsigned int per device)
+        self.seqs = array('I', bytes(4 * len(self.device_ids)))
+        self.running = True
+
+        self.data_sent = 0
+        self.heartbeats_sent = 0
+        self.retransmits = 0
+        self.errors = 0
+
+        # Reliability mode: per-device send history, NACKs polled in the scheduler loop
+        self.histories = [SendHistory(FLEET_RETX_HISTORY) for _ in self.device_ids] if reliable else None
+        self._index = {d: i for i, d in enumerate(self.device_ids)} if reliable else None
+        if reliable:
+            for s in self.socks:
+                s.setblocking(False)
+
+        # Deadline heap of (due_time, msg_type, device_index, packet);
+        # packet is only set for DEFERRED entries queued by defer()
+        self._events = []
+        self._t0 = time.time()
+
+    def now(self):
+        """Current (virtual) time in seconds."""
+        return self._t0 + (time.time() - self._t0) * self.speed
+
+    def _make_reading(self):
+        """Generate a mock sensor reading (temperature)."""
+        return round(random.uniform(20.0, 30.0), 2)
+
+    def _transmit(self, idx, pkt):
+        """Hands a built packet to the network; override to impair traffic."""
+        return self._send_now(idx, pkt)
+
+    def defer(self, idx, pkt, delay):
+        """Queues pkt to go out on device idx's socket after delay (virtual) seconds."""
+        heapq.heappush(self._events, (self.now() + delay, DEFERRED, idx, pkt))
+
+    def _send_now(self, idx, pkt):
+        """Sends one packet for device idx on its shared socket."""
+        try:
+            self.socks[idx % len(self.socks)].sendto(pkt, self.server)
+            return True
+        except Exception:
+            self.errors += 1
+            return False
+
+    def send_data(self, idx):
+        """Builds and sends a DATA packet for device idx."""
+        readings = [self._make_reading() for _ in range(self.batch_size)]
+        pkt = build_packet(self.device_ids[idx], self.seqs[idx], DATA, readings)
+        if self.auth:
+            pkt = self.auth.sign(self.device_ids[idx], pkt)
+        if self.histories:
+            self.histories[idx].add(self.seqs[idx], pkt)
+        if self._transmit(idx, pkt):
+            self.data_sent += 1
+            self.seqs[idx] = (self.seqs[idx] + 1) & 0xFFFFFFFF
+
+    def send_heartbeat(self, idx):
+        """Sends a HEARTBEAT packet for device idx (seq is not incremented)."""
+        pkt = build_packet(self.device_ids[idx], self.seqs[idx], HEARTBEAT, [])
+        if self.auth:
+            pkt = self.auth.sign(self.device_ids[idx], pkt)
+        if self._transmit(idx, pkt):
+            self.heartbeats_sent += 1
+
+    def _wait(self, delay):
+        """
+        Sleeps for delay real seconds; in reliability mode, serves NACKs meanwhile.
+        Called on every scheduler pass (delay may be <= 0), so a fleet that is
+        behind schedule still polls its sockets once per send.
+        """
+        if self.histories is None:
+            if delay > 0:
+                time.sleep(delay)
+            return
+        end = time.time() + delay
+        while True:
+            readable, _, _ = select.select(self.socks, [], [], max(0.0, end - time.time()))
+            for s in readable:
+                self._drain_nacks(s)
+            if time.time() >= end:
+                return
+
+    def _drain_nacks(self, sock):
+        while True:
+            try:
+                data, _ = sock.recvfrom(2048)
+            except OSError:
+                # BlockingIOError: nothing left to read
+                return
+            nack = read_nack(data, self.auth)
+            if nack is None or nack[0] not in self._index:
+                continue
+            idx = self._index[nack[0]]
+            for _, pkt in self.histories[idx].lookup(nack[1]):
+                if self._transmit(idx, pkt):
+                    self.retransmits += 1
+
+    def _schedule_all(self, start_time):
+        """Spreads first deadlines over one interval so devices don't send in lockstep."""
+        n = len(self.device_ids)
+        events = []
+        for idx in range(n):
+            offset = idx / n
+            events.append((start_time + offset * self.reporting_interval, DATA, idx, b""))
+            events.append((start_time + (offset + 1) * self.heartbeat_interval, HEARTBEAT, idx, b""))
+        heapq.heapify(events)
+        self._events = events
+
+    def run(self, duration=None, linger=0.0):
+        """
+        Main scheduler loop: pops due deadlines, sends, and re-arms them.
+        linger: real seconds to keep answering NACKs after the last send.
+        """
+        print(f"[Fleet] {len(self.device_ids)} devices on {len(self.socks)} sockets, "
+              f"reporting every {self.reporting_interval}s, Batching={self.batch_size}", flush=True)
+        self._t0 = start_time = time.time()
+        end_time = start_time + duration if duration else None
+        self._schedule_all(start_time)
+        events = self._events
+
+        try:
+            while self.running and events:
+                due, msg_type, idx, pkt = events[0]
+                if end_time is not None and due >= end_time and msg_type != DEFERRED:
+                    # stop scheduling sends, but deliver deferred packets (already counted as sent)
+                    print("[Fleet] Duration reached. Stopping...", flush=True)
+                    events[:] = [e for e in events if e[1] == DEFERRED]
+                    heapq.heapify(events)
+                    end_time = None
+                    continue
+
+                self._wait((due - self.now()) / self.speed)
+
+                # pop before sending: an impaired _transmit may push deferred packets
+                heapq.heappop(events)
+                if msg_type == DEFERRED:
+                    self._send_now(idx, pkt)
+                    continue
+                if msg_type == DATA:
+                    self.send_data(idx)
+                    interval = self.reporting_interval
+                else:
+                    self.send_heartbeat(idx)
+                    interval = self.heartbeat_interval
+                heapq.heappush(events, (due + interval, msg_type, idx, b""))
+
+            if linger > 0 and self.histories is not None:
+                self._wait(linger)
+
+        except KeyboardInterrupt:
+            print("[Fleet] Interrupted by user.", flush=True)
+        finally:
+            self.running = False
+            for s in self.socks:
+                s.close()
+            print(f"[Fleet] sent DATA={self.data_sent} HEARTBEAT={self.heartbeats_sent} "
+                  f"retransmits={self.retransmits} errors={self.errors}", flush=True)
+
 if __name__ == "__main__":
     # Parsing command line arguments for the shell script (run_experiments.sh)
     parser = argparse.ArgumentParser(description="IoT Telemetry Sensor Client")
@@ -97,15 +388,46 @@ if __name__ == "__main__":
     parser.add_argument("--batch", type=int, default=1, help="Number of readings per packet")
     parser.add_argument("--duration", type=int, default=60, help="Duration to run the client in seconds")
     parser.add_argument("--ip", type=str, default="127.0.0.1", help="Server IP address")
+    parser.add_argument("--port", type=int, default=5555, help="Server UDP port")
+    parser.add_argument("--devices", type=int, default=1, help="Number of devices to emulate (IDs start at --id)")
+    parser.add_argument("--sockets", type=int, default=4, help="Shared sockets used in fleet mode (--devices > 1)")
+    parser.add_argument("--reliable", action="store_true", help="Retransmit DATA packets the server NACKs")
+    parser.add_argument("--linger", type=float, default=NACK_LINGER,
+                        help="With --reliable, seconds to keep answering NACKs after the last send")
+    parser.add_argument("--key-file", type=str, default=os.environ.get("TT_KEY_FILE"),
+                        help="Device keys from auth.py for signed packets (default: $TT_KEY_FILE)")
     
     args = parser.parse_args()
+    keys = load_device_keys(args.key_file) if args.key_file else None
+    if keys is not None:
+        unkeyed = [d for d in range(args.id, args.id + args.devices) if d & 0xFFFF not in keys]
+        if unkeyed:
+            parser.error(f"--key-file has no key for device {unkeyed[0]}")
+
+    if args.devices > 1:
+        # Fleet mode: one scheduler thread drives every device
+        fleet = FleetClient(
+            device_ids=range(args.id, args.id + args.devices),
+            reporting_interval=args.interval,
+            batch_size=args.batch,
+            server_ip=args.ip,
+            server_port=args.port,
+            sockets=args.sockets,
+            auth_keys=keys,
+            reliable=args.reliable
+        )
+        fleet.run(duration=args.duration, linger=args.linger)
+        sys.exit(0)
 
     # Create and run the client
     client = SensorClient(
         device_id=args.id,
         reporting_interval=args.interval,
         batch_size=args.batch,
-        server_ip=args.ip
+        server_ip=args.ip,
+        server_port=args.port,
+        device_key=keys[args.id & 0xFFFF] if keys else None,
+        reliable=args.reliable
     )
     
-    client.run(duration=args.duration)
+    client.run(duration=args.duration, linger=args.linger)
@@ -12,10 +12,14 @@ VERSION = 1
 
 DATA = 1
 HEARTBEAT = 2
+NACK = 3        # server -> client: ranges of missing seqs to retransmit
 
 HEADER_FORMAT = "!H I I B B"   # device_id, seq, timestamp, msg_type, batch_count
 HEADER_SIZE = struct.calcsize(HEADER_FORMAT)
 READING_SIZE = 4  # float32 per reading
+NACK_RANGE_FORMAT = "!I I"   # first_seq, last_seq (inclusive)
+NACK_RANGE_SIZE = struct.calcsize(NACK_RANGE_FORMAT)
+MAX_NACK_RANGES = 255        # batch_count carries the number of ranges
 
 def now_ts():
     return int(time.time())
@@ -46,3 +50,28 @@ def parse_readings(data: bytes, count: int):
             raise ValueError("not enough bytes for reading")
         readings.append(struct.unpack("!f", chunk)[0])
     return readings
+
+def build_nack(device_id: int, ranges: list):
+    """
+    Build a NACK packet: header (seq=0, batch_count=len(ranges)) followed by
+    (first_seq, last_seq) uint32 pairs. At most MAX_NACK_RANGES ranges.
+    """
+    ranges = ranges[:MAX_NACK_RANGES]
+    header = struct.pack(HEADER_FORMAT, device_id & 0xFFFF, 0, now_ts() & 0xFFFFFFFF, NACK, len(ranges))
+    body = b"".join(struct.pack(NACK_RANGE_FORMAT, a & 0xFFFFFFFF, b & 0xFFFFFFFF) for a, b in ranges)
+    return header + body
+
+def parse_nack(data: bytes, count: int):
+    if len(data) < count * NACK_RANGE_SIZE:
+        raise ValueError("not enough bytes for nack ranges")
+    return [struct.unpack_from(NACK_RANGE_FORMAT, data, i * NACK_RANGE_SIZE) for i in range(count)]
+
+def seqs_to_ranges(seqs):
+    """Coalesce an iterable of seqs into sorted inclusive (first, last) ranges."""
+    ranges = []
+    for s in sorted(seqs):
+        if ranges and s == ranges[-1][1] + 1:
+            ranges[-1][1] = s
+        else:
+            ranges.append([s, s])
+    return [tuple(r) for r in ranges]
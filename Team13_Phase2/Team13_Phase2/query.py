@@ -0,0 +1,42 @@
+#!/usr/bin/env python3
+# query.py
+# Asks a running server for a device's cached readings over the local query API.
+import socket
+import json
+import argparse
+
+from cache import decode_readings
+
+def query(request, host="127.0.0.1", port=5556, timeout=2.0):
+    with socket.socket(socket.AF_INET, socket.SOCK_DGRAM) as s:
+        s.settimeout(timeout)
+        s.sendto(json.dumps(request).encode(), (host, port))
+        data, _ = s.recvfrom(65535)
+    return json.loads(data)
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Query cached readings from a TinyTelemetry server")
+    parser.add_argument("--id", type=int, required=True, help="Device ID")
+    parser.add_argument("--last", type=float, default=300, help="Seconds back from now")
+    parser.add_argument("--start", type=float, default=None, help="Range start (epoch seconds); overrides --last")
+    parser.add_argument("--end", type=float, default=None, help="Range end (epoch seconds)")
+    parser.add_argument("--port", type=int, default=5556, help="Server query port")
+    args = parser.parse_args()
+
+    request = {"device_id": args.id}
+    if args.start is not None:
+        request["start"] = args.start
+        if args.end is not None:
+            request["end"] = args.end
+    else:
+        request["last"] = args.last
+
+    reply = query(request, port=args.port)
+    if "error" in reply:
+        print("[Query] error:", reply["error"])
+    else:
+        readings = decode_readings(reply)
+        print(f"[Query] dev={reply['device_id']} latest={reply['latest']} "
+              f"readings={len(readings)} truncated={reply['truncated']}")
+        for ts, value in readings:
+            print(f"{ts},{value:.2f}")
@@ -0,0 +1,261 @@
+# replay.py
+# Offline replay of a server telemetry_log.csv with vectorized NumPy group-bys.
+# Recomputes per-device loss, duplicates, reorder depth, inter-arrival jitter
+# and delay from the raw (device_id, seq, timestamp, arrival_time) columns
+# instead of trusting the duplicate_flag/gap_flag columns written live.
+#
+# usage:
+#   python replay.py results/baseline_1s
+#   python replay.py results/baseline_1s/telemetry_log.csv --json replay.json
+#   python replay.py --diff results/baseline_1s results/loss_5pct
+
+import os
+import sys
+import json
+import argparse
+
+import numpy as np
+import pandas as pd
+
+NDEV = 1 << 16              # device_id is uint16 -> dense per-device arrays
+CHUNK_ROWS = 1_000_000      # rows per chunk; bounds memory for huge logs
+DELAY_MIN = -60             # delay histogram range in seconds (arrival - timestamp)
+DELAY_MAX = 3600
+LOG_NAMES = ["telemetry_log.csv", "log.csv"]   # current and older result layouts
+NOTES_NAME = "notes.txt"    # scenario settings written by test.py
+COLUMNS = ["device_id", "seq", "timestamp", "arrival_time", "heartbeat_flag"]
+
+
+def resolve_log(path):
+    if os.path.isdir(path):
+        for name in LOG_NAMES:
+            candidate = os.path.join(path, name)
+            if os.path.exists(candidate):
+                return candidate
+        raise FileNotFoundError(f"no telemetry log in {path}")
+    return path
+
+
+def run_speed(log_path):
+    """Virtual clock speed the run was recorded at (test.py notes.txt), 1.0 if unknown."""
+    notes = os.path.join(os.path.dirname(os.path.abspath(log_path)), NOTES_NAME)
+    try:
+        with open(notes) as nf:
+            return float(json.load(nf).get("speed", 1.0))
+    except (OSError, ValueError, AttributeError):
+        return 1.0
+
+
+class Replay:
+    """
+    Per-device accumulators indexed directly by device_id. Each chunk is
+    folded in with bincount / ufunc.at; the carry arrays (last arrival,
+    highest seq, previous chunk's keys) let stats continue across chunks.
+    Duplicates are matched within the current and previous chunk only.
+    """
+    def __init__(self):
+        self.received = np.zeros(NDEV, np.int64)
+        self.heartbeats = np.zeros(NDEV, np.int64)
+        self.duplicates = np.zeros(NDEV, np.int64)
+        self.reordered = np.zeros(NDEV, np.int64)
+        self.reorder_depth = np.zeros(NDEV, np.int64)
+        self.seq_min = np.full(NDEV, np.iinfo(np.int64).max, np.int64)
+        self.seq_max = np.full(NDEV, -1, np.int64)
+        self.ia_n = np.zeros(NDEV, np.int64)
+        self.ia_sum = np.zeros(NDEV, np.float64)
+        self.ia_sumsq = np.zeros(NDEV, np.float64)
+        self.delay_sum = np.zeros(NDEV, np.float64)
+        self.delay_max = np.full(NDEV, -np.inf, np.float64)
+        self.delay_hist = np.zeros(DELAY_MAX - DELAY_MIN + 1, np.int64)
+        self.last_arrival = np.full(NDEV, np.nan, np.float64)
+        self.prev_keys = np.empty(0, np.int64)
+        self.rows = 0
+
+    def feed(self, dev, seq, ts, arrival, hb):
+        self.rows += len(dev)
+        self.heartbeats += np.bincount(dev[hb], minlength=NDEV)
+        data = ~hb
+        dev, seq, ts, arrival = dev[data], seq[data], ts[data], arrival[data]
+        if len(dev) == 0:
+            return
+
+        # group rows by device, keeping file (arrival) order inside each group
+        order = np.argsort(dev, kind="stable")
+        dev, seq, ts, arrival = dev[order], seq[order], ts[order], arrival[order]
+        starts = np.ones(len(dev), bool)
+        starts[1:] = dev[1:] != dev[:-1]
+
+        self.received += np.bincount(dev, minlength=NDEV)
+        np.minimum.at(self.seq_min, dev, seq)
+
+        # duplicates: repeated (device, seq) key in this chunk or the previous one
+        keys = (dev << 32) | seq
+        uniq, first = np.unique(keys, return_index=True)
+        dup = np.ones(len(keys), bool)
+        dup[first] = False
+        dup[first[np.isin(uniq, self.prev_keys, assume_unique=True)]] = True
+        self.duplicates += np.bincount(dev[dup], minlength=NDEV)
+        self.prev_keys = uniq
+
+        # reorder depth: highest seq seen earlier for the same device minus this seq.
+        # Offsetting seq by device makes one global running max act per group.
+        offset = dev << 33
+        running = np.maximum.accumulate(offset + seq)
+        before = np.empty(len(dev), np.int64)
+        before[0] = -1
+        before[1:] = running[:-1]
+        before = np.maximum(before - offset, -1)
+        before = np.maximum(before, self.seq_max[dev])
+        depth = before - seq
+        late = (depth > 0) & ~dup
+        self.reordered += np.bincount(dev[late], minlength=NDEV)
+        np.maximum.at(self.reorder_depth, dev[late], depth[late])
+        np.maximum.at(self.seq_max, dev, seq)
+
+        # inter-arrival times, continuing from the previous chunk's last arrival
+        prev = np.empty(len(dev), np.float64)
+        prev[1:] = arrival[:-1]
+        prev[starts] = self.last_arrival[dev[starts]]
+        valid = ~np.isnan(prev)
+        gaps = arrival[valid] - prev[valid]
+        self.ia_n += np.bincount(dev[valid], minlength=NDEV)
+        self.ia_sum += np.bincount(dev[valid], weights=gaps, minlength=NDEV)
+        self.ia_sumsq += np.bincount(dev[valid], weights=gaps * gaps, minlength=NDEV)
+        ends = np.ones(len(dev), bool)
+        ends[:-1] = starts[1:]
+        self.last_arrival[dev[ends]] = arrival[ends]
+
+        # one-way delay (same-host clocks)
+        delay = arrival - ts
+        self.delay_sum += np.bincount(dev, weights=delay, minlength=NDEV)
+        np.maximum.at(self.delay_max, dev, delay)
+        bins = np.clip(np.rint(delay).astype(np.int64), DELAY_MIN, DELAY_MAX) - DELAY_MIN
+        self.delay_hist += np.bincount(bins, minlength=len(self.delay_hist))
+
+    def _percentile(self, q):
+        total = self.delay_hist.sum()
+        if total == 0:
+            return 0.0
+        idx = np.searchsorted(np.cumsum(self.delay_hist), q * total)
+        return float(idx + DELAY_MIN)
+
+    def summary(self):
+        seen = np.flatnonzero((self.received > 0) | (self.heartbeats > 0))
+        unique = self.received - self.duplicates
+        expected = np.where(self.received > 0, self.seq_max - self.seq_min + 1, 0)
+        lost = np.maximum(expected - unique, 0)
+        n = np.maximum(self.ia_n, 1)
+        ia_mean = self.ia_sum / n
+        jitter = np.sqrt(np.maximum(self.ia_sumsq / n - ia_mean ** 2, 0.0))
+        delay_mean = self.delay_sum / np.maximum(self.received, 1)
+
+        devices = {}
+        for d in seen:
+            devices[int(d)] = {
+                "received": int(self.received[d]),
+                "heartbeats": int(self.heartbeats[d]),
+                "expected": int(expected[d]),
+                "lost": int(lost[d]),
+                "loss_rate": float(lost[d] / expected[d]) if expected[d] > 0 else 0.0,
+                "duplicates": int(self.duplicates[d]),
+                "reordered": int(self.reordered[d]),
+                "max_reorder_depth": int(self.reorder_depth[d]),
+                "interarrival_mean": float(ia_mean[d]),
+                "interarrival_jitter": float(jitter[d]),
+                "delay_mean": float(delay_mean[d]),
+                "delay_max": float(self.delay_max[d]) if self.received[d] > 0 else 0.0,
+            }
+
+        received = int(self.received.sum())
+        total_expected = int(expected.sum())
+        total_lost = int(lost.sum())
+        totals = {
+            "rows": self.rows,
+            "devices": len(devices),
+            "received": received,
+            "heartbeats": int(self.heartbeats.sum()),
+            "expected": total_expected,
+            "lost": total_lost,
+            "loss_rate": total_lost / total_expected if total_expected > 0 else 0.0,
+            "duplicates": int(self.duplicates.sum()),
+            "duplicate_rate": int(self.duplicates.sum()) / received if received > 0 else 0.0,
+            "reordered": int(self.reordered.sum()),
+            "max_reorder_depth": int(self.reorder_depth.max()),
+            "interarrival_jitter_mean": float(jitter[seen].mean()) if len(seen) else 0.0,
+            "delay_p50": self._percentile(0.50),
+            "delay_p95": self._percentile(0.95),
+            "delay_p99": self._percentile(0.99),
+        }
+        return {"totals": totals, "devices": devices}
+
+
+def replay(path, chunk_rows=CHUNK_ROWS):
+    r = Replay()
+    log_path = resolve_log(path)
+    reader = pd.read_csv(log_path, usecols=COLUMNS, chunksize=chunk_rows,
+                         dtype={"device_id": np.int64, "seq": np.int64, "timestamp": np.float64,
+                                "arrival_time": np.float64, "heartbeat_flag": np.int8})
+    for chunk in reader:
+        r.feed(chunk["device_id"].to_numpy() & 0xFFFF,
+               chunk["seq"].to_numpy(),
+               chunk["timestamp"].to_numpy(),
+               chunk["arrival_time"].to_numpy(),
+               chunk["heartbeat_flag"].to_numpy() != 0)
+    result = r.summary()
+    result["totals"]["speed"] = run_speed(log_path)
+    return result
+
+
+def compressed_note(name, result):
+    speed = result["totals"]["speed"]
+    if speed != 1.0:
+        print(f"  note: {name} ran time-compressed (speed={speed:g}); inter-arrival and jitter are in "
+              f"compressed seconds and delay stats are not comparable with real-time runs")
+
+
+def print_summary(name, result):
+    print(f"=== {name} ===")
+    for k, v in result["totals"].items():
+        print(f"  {k:26s} {v:.4f}" if isinstance(v, float) else f"  {k:26s} {v}")
+    compressed_note(name, result)
+
+
+def print_diff(name_a, a, name_b, b):
+    print(f"{'metric':26s} {name_a:>18s} {name_b:>18s} {'delta':>12s}")
+    for k, va in a["totals"].items():
+        vb = b["totals"].get(k, 0)
+        if isinstance(va, float) or isinstance(vb, float):
+            print(f"{k:26s} {va:18.4f} {vb:18.4f} {vb - va:+12.4f}")
+        else:
+            print(f"{k:26s} {va:18d} {vb:18d} {vb - va:+12d}")
+    compressed_note(name_a, a)
+    compressed_note(name_b, b)
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Replay and analyse TinyTelemetry logs")
+    parser.add_argument("paths", nargs="*", help="Log file(s) or result folder(s)")
+    parser.add_argument("--diff", nargs=2, metavar=("RUN_A", "RUN_B"), help="Compare two runs")
+    parser.add_argument("--chunk", type=int, default=CHUNK_ROWS, help="Rows per chunk")
+    parser.add_argument("--json", type=str, default=None, help="Write full per-device results to this file")
+    args = parser.parse_args()
+
+    if args.diff:
+        run_a, run_b = args.diff
+        res_a, res_b = replay(run_a, args.chunk), replay(run_b, args.chunk)
+        print_diff(os.path.basename(os.path.normpath(run_a)), res_a,
+                   os.path.basename(os.path.normpath(run_b)), res_b)
+        results = {run_a: res_a, run_b: res_b}
+    elif args.paths:
+        results = {}
+        for p in args.paths:
+            results[p] = replay(p, args.chunk)
+            print_summary(p, results[p])
+    else:
+        parser.print_help()
+        sys.exit(1)
+
+    if args.json:
+        with open(args.json, "w") as jf:
+            json.dump(results, jf, indent=2)
+        print("Wrote", args.json)
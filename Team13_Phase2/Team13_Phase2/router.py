@@ -0,0 +1,170 @@
+#!/usr/bin/env python3
+# router.py
+# UDP front-end that spreads TinyTelemetry devices over several collectors.
+# Only the 12-byte header is parsed; device_id is consistent-hashed onto a
+# ring of backends so each device's dedup/reorder state stays on one node,
+# and adding/removing a backend only moves the devices on its arcs.
+# Replies from collectors (NACKs) are relayed back to the device by device_id.
+import socket
+import threading
+import hashlib
+import struct
+import json
+import argparse
+import signal
+import sys
+from bisect import bisect
+
+from protocol import parse_header
+
+VNODES = 100        # ring points per backend; more points = more even spread
+RCVBUF = 4 << 20    # front socket receive buffer, absorbs bursts
+NUM_DEVICES = 1 << 16
+
+def parse_addr(text):
+    host, port = text.rsplit(":", 1)
+    return host, int(port)
+
+def _point(key: bytes):
+    return int.from_bytes(hashlib.blake2b(key, digest_size=8).digest(), "big")
+
+class HashRing:
+    """Consistent-hash ring with a precomputed device_id -> backend table."""
+    def __init__(self, backends=(), vnodes=VNODES):
+        self.vnodes = vnodes
+        self.backends = list(backends)
+        self._rebuild()
+
+    def add(self, backend):
+        if backend not in self.backends:
+            self.backends.append(backend)
+            self._rebuild()
+
+    def remove(self, backend):
+        if backend in self.backends:
+            self.backends.remove(backend)
+            self._rebuild()
+
+    def _rebuild(self):
+        ring = sorted((_point(f"{h}:{p}#{i}".encode()), (h, p))
+                      for h, p in self.backends for i in range(self.vnodes))
+        if not ring:
+            self.table = [None] * NUM_DEVICES
+            return
+        points = [pt for pt, _ in ring]
+        owners = [b for _, b in ring]
+        n = len(ring)
+        # swap in a whole new table so the forwarding loop never sees a partial one
+        self.table = [owners[bisect(points, _point(struct.pack("!H", d))) % n]
+                      for d in range(NUM_DEVICES)]
+
+    def lookup(self, device_id):
+        return self.table[device_id]
+
+def moved_fraction(old_table, new_table):
+    """Share of device_ids whose backend differs between two tables."""
+    return sum(1 for a, b in zip(old_table, new_table) if a != b) / len(old_table)
+
+class Router:
+    def __init__(self, backends, listen_ip="0.0.0.0", listen_port=5555, vnodes=VNODES):
+        self.ring = HashRing(backends, vnodes)
+        self.sock = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+        self.sock.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+        self.sock.setsockopt(socket.SOL_SOCKET, socket.SO_RCVBUF, RCVBUF)
+        self.sock.bind((listen_ip, listen_port))
+        self.upstream = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+        self.upstream.bind(("0.0.0.0", 0))
+        self.clients = {}    # device_id -> last source address, for relaying replies
+        self.forwarded = 0
+        self.dropped = 0
+        self.relayed = 0
+        self.running = True
+
+    def serve(self):
+        """Forwarding loop: one recvfrom, one header parse, one table lookup, one sendto."""
+        threading.Thread(target=self._relay_loop, daemon=True).start()
+        recv, send, clients = self.sock.recvfrom, self.upstream.sendto, self.clients
+        while self.running:
+            try:
+                data, addr = recv(4096)
+                device_id = parse_header(data)[0]
+            except ValueError:
+                self.dropped += 1
+                continue
+            except OSError:
+                break
+            backend = self.ring.table[device_id]
+            if backend is None:
+                self.dropped += 1
+                continue
+            clients[device_id] = addr
+            try:
+                send(data, backend)
+                self.forwarded += 1
+            except OSError:
+                self.dropped += 1
+
+    def _relay_loop(self):
+        # collector -> router -> device (e.g. NACKs), routed by the header's device_id
+        while self.running:
+            try:
+                data, _ = self.upstream.recvfrom(4096)
+                addr = self.clients.get(parse_header(data)[0])
+            except ValueError:
+                continue
+            except OSError:
+                return
+            if addr is not None:
+                try:
+                    self.sock.sendto(data, addr)
+                    self.relayed += 1
+                except OSError:
+                    pass
+
+    def control_loop(self, port):
+        # local JSON control: {"add": "host:port"} / {"remove": "host:port"} / {"backends": null}
+        ctl = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+        ctl.bind(("127.0.0.1", port))
+        while self.running:
+            data, addr = ctl.recvfrom(4096)
+            try:
+                req = json.loads(data)
+                old = self.ring.table
+                if "add" in req:
+                    self.ring.add(parse_addr(req["add"]))
+                if "remove" in req:
+                    self.ring.remove(parse_addr(req["remove"]))
+                reply = {"backends": [f"{h}:{p}" for h, p in self.ring.backends],
+                         "moved": moved_fraction(old, self.ring.table)}
+                print(f"[Router] backends={reply['backends']} moved={reply['moved']:.3f}", flush=True)
+            except Exception as e:
+                reply = {"error": str(e)}
+            ctl.sendto(json.dumps(reply).encode(), addr)
+
+    def close(self):
+        self.running = False
+        self.sock.close()
+        self.upstream.close()
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="TinyTelemetry consistent-hash router")
+    parser.add_argument("--port", type=int, default=5555, help="UDP port devices send to (0 = any free port)")
+    parser.add_argument("--backends", type=str, required=True, help="Comma-separated collector host:port list")
+    parser.add_argument("--vnodes", type=int, default=VNODES, help="Ring points per backend")
+    parser.add_argument("--control-port", type=int, default=None, help="Local UDP port for add/remove commands")
+    args = parser.parse_args()
+
+    backends = [parse_addr(b) for b in args.backends.split(",") if b]
+    router = Router(backends, listen_port=args.port, vnodes=args.vnodes)
+    if args.control_port:
+        threading.Thread(target=router.control_loop, args=(args.control_port,), daemon=True).start()
+    signal.signal(signal.SIGTERM, lambda sig, frame: sys.exit(0))
+    # the real port when started with --port 0
+    print(f"[Router] Listening on 0.0.0.0:{router.sock.getsockname()[1]}, backends={args.backends}", flush=True)
+    try:
+        router.serve()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        router.close()
+        print(f"[Router] forwarded={router.forwarded} relayed={router.relayed} dropped={router.dropped}", flush=True)
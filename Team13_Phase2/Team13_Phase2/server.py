@@ -8,28 +8,64 @@ import signal
 import sys
 import json
 import os
+import argparse
 
-from protocol import HEADER_SIZE, parse_header, parse_readings, DATA, HEARTBEAT
+from protocol import HEADER_SIZE, parse_header, parse_readings, build_nack, seqs_to_ranges, DATA, HEARTBEAT, MAX_NACK_RANGES
+from cache import ReadingCache, encode_reply
+from auth import PacketAuth
+
+parser = argparse.ArgumentParser(description="TinyTelemetry collector")
+parser.add_argument("--port", type=int, default=5555, help="UDP port to listen on (0 = any free port)")
+parser.add_argument("--auth-secret", type=str, default=os.environ.get("TT_AUTH_SECRET"),
+                    help="Require signed packets using this shared secret (default: $TT_AUTH_SECRET)")
+parser.add_argument("--nack", action="store_true", help="Reliability mode: NACK detected gaps so clients retransmit")
+parser.add_argument("--outdir", type=str, default=".", help="Folder for CSV/JSON outputs")
+parser.add_argument("--query-port", type=int, default=None, help="Enable the reading query API on this local UDP port (0 = any free port)")
+args, _ = parser.parse_known_args()
 
 # config
 SERVER_IP = "0.0.0.0"
-SERVER_PORT = 5555
+SERVER_PORT = args.port
+QUERY_IP = "127.0.0.1"       # query API is local-only
+QUERY_PORT = args.query_port  # None = no query API and no reading cache
 HEARTBEAT_TIMEOUT = 10       # seconds to declare device offline
 REORDER_FLUSH_INTERVAL = 5   # seconds
 METRICS_DUMP_INTERVAL = 2    # seconds
 RECENT_WINDOW = 500          # number of recent seqs to remember per device
+NACK_ENABLED = args.nack
+NACK_INTERVAL = 1.0          # seconds between NACK rounds
+NACK_MAX_TRIES = 3           # NACKs per missing seq before giving up
+MAX_MISSING = 1024           # missing seqs tracked per device
 
 # outputs
-LOG_CSV = "telemetry_log.csv"
-REORDERED_CSV = "telemetry_reordered.csv"
-METRICS_JSON = "metrics.json"
+os.makedirs(args.outdir, exist_ok=True)
+LOG_CSV = os.path.join(args.outdir, "telemetry_log.csv")
+REORDERED_CSV = os.path.join(args.outdir, "telemetry_reordered.csv")
+METRICS_JSON = os.path.join(args.outdir, "metrics.json")
+
+# packet authentication (None = accept unsigned packets)
+packet_auth = PacketAuth(args.auth_secret) if args.auth_secret else None
 
 # socket
 sock = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
 sock.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
 sock.bind((SERVER_IP, SERVER_PORT))
+SERVER_PORT = sock.getsockname()[1]   # the real port when started with --port 0
 print(f"[Server] Listening on {SERVER_IP}:{SERVER_PORT}")
 
+query_sock = None
+if QUERY_PORT is not None:
+    query_sock = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+    try:
+        query_sock.bind((QUERY_IP, QUERY_PORT))
+        QUERY_PORT = query_sock.getsockname()[1]   # the real port when started with --query-port 0
+        print(f"[Server] Query API on {QUERY_IP}:{QUERY_PORT}")
+    except OSError as e:
+        # the collector still runs; only the query API is unavailable
+        print(f"[Server] Query API disabled, cannot bind {QUERY_IP}:{QUERY_PORT}: {e}")
+        query_sock.close()
+        query_sock = None
+
 # per-device state and global metrics
 device_states = {}  # device_id -> { last_seq, recent(deque), last_heartbeat, offline_flag }
 device_lock = threading.Lock()
@@ -40,6 +76,10 @@ metrics = {
     "duplicates": 0,
     "gaps": 0,
     "reads_processed": 0,
+    "auth_failures": 0,
+    "nacks_sent": 0,
+    "nack_bytes": 0,
+    "recovered": 0,
     "processing_cpu_seconds": 0.0
 }
 metrics_lock = threading.Lock()
@@ -47,6 +87,9 @@ metrics_lock = threading.Lock()
 reorder_buffer = []   # list of tuples (pkt_timestamp, device_id, seq, readings, arrival_time)
 reorder_lock = threading.Lock()
 
+# recent readings per device, only kept when the query API is up
+reading_cache = ReadingCache() if query_sock is not None else None
+
 # ensure output files exist and header rows
 log_file = open(LOG_CSV, "w", newline="")
 log_writer = csv.writer(log_file)
@@ -78,33 +121,47 @@ def monitor_offline():
                     st['offline'] = (now - st['last_heartbeat'] > HEARTBEAT_TIMEOUT)
                 else:
                     st['offline'] = True
+        if reading_cache is not None:
+            reading_cache.evict_idle(time.time())
+
+def metrics_snapshot():
+    """Derived metrics written to metrics.json (periodically and on shutdown)."""
+    with metrics_lock:
+        reads = metrics.get("reads_processed", 0)
+        packets = metrics.get("packets_received", 0)
+        bytes_recv = metrics.get("bytes_received", 0)
+        duplicates = metrics.get("duplicates", 0)
+        gaps = metrics.get("gaps", 0)
+        auth_failures = metrics.get("auth_failures", 0)
+        nacks_sent = metrics.get("nacks_sent", 0)
+        nack_bytes = metrics.get("nack_bytes", 0)
+        recovered = metrics.get("recovered", 0)
+        cpu_s = metrics.get("processing_cpu_seconds", 0.0)
+    cpu_ms_per_report = (cpu_s / reads * 1000.0) if reads > 0 else 0.0
+    bytes_per_report = (bytes_recv / reads) if reads > 0 else 0.0
+    duplicate_rate = (duplicates / packets) if packets > 0 else 0.0
+    return {
+        "packets_received": packets,
+        "reads_processed": reads,
+        "bytes_received": bytes_recv,
+        "bytes_per_report": bytes_per_report,
+        "duplicates": duplicates,
+        "duplicate_rate": duplicate_rate,
+        "gaps": gaps,
+        "auth_failures": auth_failures,
+        "nacks_sent": nacks_sent,
+        "nack_bytes": nack_bytes,
+        "recovered": recovered,
+        "cpu_ms_per_report": cpu_ms_per_report,
+        "timestamp": int(time.time())
+    }
 
 def periodic_flush_and_metrics():
     while running:
         time.sleep(REORDER_FLUSH_INTERVAL)
         flush_reorder_buffer()
         # dump metrics JSON periodically
-        with metrics_lock:
-            reads = metrics.get("reads_processed", 0)
-            packets = metrics.get("packets_received", 0)
-            bytes_recv = metrics.get("bytes_received", 0)
-            duplicates = metrics.get("duplicates", 0)
-            gaps = metrics.get("gaps", 0)
-            cpu_s = metrics.get("processing_cpu_seconds", 0.0)
-            cpu_ms_per_report = (cpu_s / reads * 1000.0) if reads > 0 else 0.0
-            bytes_per_report = (bytes_recv / reads) if reads > 0 else 0.0
-            duplicate_rate = (duplicates / packets) if packets > 0 else 0.0
-            dump = {
-                "packets_received": packets,
-                "reads_processed": reads,
-                "bytes_received": bytes_recv,
-                "bytes_per_report": bytes_per_report,
-                "duplicates": duplicates,
-                "duplicate_rate": duplicate_rate,
-                "gaps": gaps,
-                "cpu_ms_per_report": cpu_ms_per_report,
-                "timestamp": int(time.time())
-            }
+        dump = metrics_snapshot()
         try:
             with open(METRICS_JSON, "w") as mf:
                 json.dump(dump, mf, indent=2)
@@ -118,12 +175,11 @@ def shutdown(sig, frame):
     metrics["processing_cpu_seconds"] += time.process_time() - start_cpu
     # final flushes
     flush_reorder_buffer()
-    with metrics_lock:
-        try:
-            with open(METRICS_JSON, "w") as mf:
-                json.dump(metrics, mf, indent=2)
-        except:
-            pass
+    try:
+        with open(METRICS_JSON, "w") as mf:
+            json.dump(metrics_snapshot(), mf, indent=2)
+    except:
+        pass
     try:
         log_file.close()
         reordered_file.close()
@@ -138,6 +194,66 @@ signal.signal(signal.SIGTERM, shutdown)
 threading.Thread(target=monitor_offline, daemon=True).start()
 threading.Thread(target=periodic_flush_and_metrics, daemon=True).start()
 
+def query_loop():
+    # one JSON request per datagram, one JSON reply back (see cache.ReadingCache.query)
+    while running:
+        try:
+            data, addr = query_sock.recvfrom(4096)
+        except OSError:
+            return
+        try:
+            reply = encode_reply(reading_cache.query(json.loads(data), time.time()))
+        except Exception as e:
+            reply = json.dumps({"error": str(e)}).encode()
+        try:
+            query_sock.sendto(reply, addr)
+        except OSError as e:
+            print("query reply error:", e)
+
+if query_sock is not None:
+    threading.Thread(target=query_loop, daemon=True).start()
+
+def nack_loop():
+    # every NACK_INTERVAL, send each device one NACK with its missing seqs coalesced into ranges
+    while running:
+        time.sleep(NACK_INTERVAL)
+        pending = []
+        with device_lock:
+            for dev, st in device_states.items():
+                missing = st.get('missing')
+                if not missing or 'addr' not in st:
+                    continue
+                seqs = []
+                for s in list(missing):
+                    if missing[s] >= NACK_MAX_TRIES:
+                        # out of tries (kept one extra round so a late retransmit still counts)
+                        del missing[s]
+                        continue
+                    seqs.append(s)
+                # one NACK carries at most MAX_NACK_RANGES ranges (oldest first);
+                # only seqs that actually go out use up a try, the rest wait for a later round
+                ranges = seqs_to_ranges(seqs)[:MAX_NACK_RANGES]
+                for first, last in ranges:
+                    for s in range(first, last + 1):
+                        missing[s] += 1
+                if ranges:
+                    pending.append((dev, st['addr'], ranges))
+        for dev, addr, ranges in pending:
+            pkt = build_nack(dev, ranges)
+            if packet_auth is not None:
+                pkt = packet_auth.sign(dev, pkt)
+            try:
+                sock.sendto(pkt, addr)
+            except OSError as e:
+                print("nack send error:", e)
+                continue
+            with metrics_lock:
+                metrics["nacks_sent"] += 1
+                metrics["nack_bytes"] += len(pkt)
+
+if NACK_ENABLED:
+    threading.Thread(target=nack_loop, daemon=True).start()
+
 def process_packet(data: bytes, addr):
     t0 = time.process_time()
     arrival_time = int(time.time())
@@ -145,6 +261,14 @@ def process_packet(data: bytes, addr):
         metrics["packets_received"] += 1
         metrics["bytes_received"] += len(data)
 
+    if packet_auth is not None:
+        # verified here in the worker, not in the receive loop
+        data = packet_auth.verify(data)
+        if data is None:
+            with metrics_lock:
+                metrics["auth_failures"] += 1
+            return
+
     if len(data) < HEADER_SIZE:
         # ignore malformed
         return
@@ -153,6 +277,9 @@ def process_packet(data: bytes, addr):
         device_id, seq, pkt_ts, msg_type, batch = parse_header(data)
     except Exception:
         return
+    if msg_type not in (DATA, HEARTBEAT):
+        # e.g. a NACK echoed back at us: not device telemetry, leave device state alone
+        return
     payload = data[HEADER_SIZE:]
     readings = []
     if msg_type == DATA and batch > 0:
@@ -170,8 +297,9 @@ def process_packet(data: bytes, addr):
     with device_lock:
         st = device_states.get(device_id)
         if st is None:
-            st = {"last_seq": seq, "recent": collections.deque(maxlen=RECENT_WINDOW), "offline": True}
+            st = {"last_seq": seq, "recent": collections.deque(maxlen=RECENT_WINDOW), "offline": True, "missing": {}}
             device_states[device_id] = st
+        st['addr'] = addr
 
         if msg_type == HEARTBEAT:
             st['last_heartbeat'] = arrival_time
@@ -187,8 +315,20 @@ def process_packet(data: bytes, addr):
                 gap = 1
                 with metrics_lock:
                     metrics["gaps"] += 1
+                if NACK_ENABLED:
+                    # remember the skipped seqs so nack_loop can request them
+                    missing = st['missing']
+                    for s in range(max(st['last_seq'] + 1, seq - MAX_MISSING), seq):
+                        if len(missing) >= MAX_MISSING:
+                            break
+                        missing[s] = 0
+            if st['missing'].pop(seq, None):
+                # arrived after at least one NACK
+                with metrics_lock:
+                    metrics["recovered"] += 1
             st['recent'].append(seq)
-            st['last_seq'] = seq
+            # keep the highest seq so late or retransmitted packets don't fake a gap
+            st['last_seq'] = max(st['last_seq'], seq)
 
         offline_flag = 1 if st.get('offline', False) else 0
 
@@ -200,6 +340,8 @@ def process_packet(data: bytes, addr):
     if msg_type == DATA:
         with reorder_lock:
             reorder_buffer.append((pkt_ts, device_id, seq, readings, arrival_time))
+        if not duplicate and reading_cache is not None:
+            reading_cache.add(device_id, pkt_ts, readings, arrival_time)
 
     with metrics_lock:
         metrics["reads_processed"] += max(1, len(readings))
@@ -216,5 +358,5 @@ def server_loop():
         threading.Thread(target=process_packet, args=(data, addr), daemon=True).start()
 
 if __name__ == "__main__":
-    print("[Server] Ready. Press Ctrl+C to stop.")
+    print(f"[Server] Ready on port {SERVER_PORT}. Press Ctrl+C to stop.")
     server_loop()
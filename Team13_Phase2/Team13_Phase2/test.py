@@ -1,5 +1,10 @@
 # test_phase2.py
-# Expanded test runner for Phase-2 (uses eth0 for netem)
+# Parallel test runner for Phase-2.
+# Each scenario gets its own server process, ephemeral UDP port and output
+# folder under results/, so independent scenarios run concurrently in a
+# process pool. Loss and delay/jitter are applied in-process by the client
+# (no tc/netem, which is global to the interface and cannot be shared), and
+# long-interval scenarios run on a virtual clock (speed > 1).
 import subprocess
 import os
 import time
@@ -7,21 +12,95 @@ import sys
 import shutil
 import random
 import json
-import signal
+import re
+import csv
+import socket
+import argparse
+from concurrent.futures import ProcessPoolExecutor, as_completed
 
 PY = sys.executable
 PROJECT_DIR = os.path.dirname(os.path.abspath(__file__))
 RESULTS_DIR = os.path.join(PROJECT_DIR, "results")
 os.makedirs(RESULTS_DIR, exist_ok=True)
+sys.path.append(PROJECT_DIR)
+
+from client import FleetClient, NACK_LINGER
+from protocol import HEADER_SIZE, build_packet, DATA
+from auth import PacketAuth, derive_key, TAG_SIZE
 
 SERVER_SCRIPT = os.path.join(PROJECT_DIR, "server.py")
-SCENARIO_WRAPPER = os.path.join(PROJECT_DIR, "scenario_client_run.py")
-NET_IF = "eth0"   # <- confirmed by you
+ROUTER_SCRIPT = os.path.join(PROJECT_DIR, "router.py")
+SERVER_READY_TIMEOUT = 5.0   # seconds to wait for "[Server] Ready on port N"
+SERVER_SETTLE = 0.2          # seconds for the server to read and log the last datagrams before SIGTERM
+READY_RE = re.compile(r"\[Server\] Ready on port (\d+)")
+ROUTER_READY_RE = re.compile(r"\[Router\] Listening on [\d.]+:(\d+)")
+ROUTER_SUMMARY_RE = re.compile(r"\[Router\] forwarded=(\d+) relayed=(\d+) dropped=(\d+)")
+
+SCENARIOS = [
+    dict(name="baseline_1s", duration=20, reporting_interval=1),
+    # 50 devices x 20 reports, so 5% loss is ~50 lost packets per run, not ~1
+    dict(name="loss_5pct", duration=20, reporting_interval=1, loss_prob=0.05, devices=50),
+    dict(name="loss_5pct_nack", duration=20, reporting_interval=1, loss_prob=0.05, reliable=True, devices=50),
+    dict(name="delay_100ms_10ms", duration=20, reporting_interval=1, delay_ms=100, jitter_ms=10),
+    dict(name="interval_5s", duration=60, reporting_interval=5, speed=5),
+    dict(name="interval_30s", duration=120, reporting_interval=30, speed=30),
+    dict(name="batch_5", duration=30, reporting_interval=1, batch=5),
+    dict(name="batch_10", duration=30, reporting_interval=1, batch=10),
+    # signed fleet: its packets verify, unsigned/wrong-key/spoofed ones are counted and never logged
+    dict(name="signed", duration=20, reporting_interval=1, devices=20, auth_secret="scenario-secret"),
+    # two --nack collectors behind router.py: devices must not split, NACKs must relay back
+    dict(name="router_2x_nack", duration=20, reporting_interval=1, loss_prob=0.05, reliable=True,
+         devices=50, collectors=2),
+]
+
+class ImpairedClient(FleetClient):
+    """FleetClient that drops and delays packets before they reach the socket."""
+    def __init__(self, *a, loss_prob=0.0, delay_ms=0, jitter_ms=0, **kw):
+        super().__init__(*a, **kw)
+        self.loss_prob = loss_prob
+        self.delay_s = delay_ms / 1000.0
+        self.jitter_s = jitter_ms / 1000.0
+        self.dropped = 0
+
+    def _transmit(self, idx, pkt):
+        if random.random() < self.loss_prob:
+            # lost on the wire: seq still advances, so the server sees a gap
+            self.dropped += 1
+            return True
+        if self.delay_s > 0 or self.jitter_s > 0:
+            self.defer(idx, pkt, max(0.0, random.gauss(self.delay_s, self.jitter_s)))
+            return True
+        return self._send_now(idx, pkt)
+
+def _start(cmd, workdir, log_name, ready_re):
+    # runs cmd in workdir with output to log_name; returns (proc, port) from its ready line
+    log_path = os.path.join(workdir, log_name)
+    log = open(log_path, "w")
+    proc = subprocess.Popen(cmd, cwd=workdir, stdout=log, stderr=subprocess.STDOUT)
+    log.close()
+    deadline = time.time() + SERVER_READY_TIMEOUT
+    while time.time() < deadline:
+        with open(log_path) as lf:
+            ready = ready_re.search(lf.read())
+        if ready:
+            return proc, int(ready.group(1))
+        if proc.poll() is not None:
+            break
+        time.sleep(0.02)
+    stop_server(proc)
+    raise RuntimeError(f"{os.path.basename(cmd[2])} did not start, see {log_path}")
 
-def start_server():
-    proc = subprocess.Popen([PY, SERVER_SCRIPT], cwd=PROJECT_DIR)
-    time.sleep(1.0)
-    return proc
+def start_server(workdir, extra_args=()):
+    """Starts server.py on a port it picks itself (--port 0); returns (proc, port)."""
+    # server writes its CSV/JSON outputs into its working directory
+    return _start([PY, "-u", SERVER_SCRIPT, "--port", "0"] + list(extra_args),
+                  workdir, "server.log", READY_RE)
+
+def start_router(workdir, ports):
+    """Starts router.py on a free port in front of local collectors; returns (proc, port)."""
+    backends = ",".join(f"127.0.0.1:{p}" for p in ports)
+    return _start([PY, "-u", ROUTER_SCRIPT, "--port", "0", "--backends", backends],
+                  workdir, "router.log", ROUTER_READY_RE)
 
 def stop_server(proc):
     if not proc:
@@ -32,94 +111,167 @@ def stop_server(proc):
     except:
         proc.kill()
 
-def apply_netem(cmd):
-    # cmd is the netem parameters e.g., "loss 5%" or "delay 100ms 10ms"
-    try:
-        subprocess.run(["sudo", "tc", "qdisc", "add", "dev", NET_IF, "root", "netem"] + cmd.split(), check=True)
-        print("[netem] applied:", cmd)
-    except Exception as e:
-        print("[netem] apply error:", e)
+def logged_devices(workdir):
+    with open(os.path.join(workdir, "telemetry_log.csv"), newline="") as f:
+        return {int(row["device_id"]) for row in csv.DictReader(f)}
 
-def clear_netem():
-    try:
-        subprocess.run(["sudo", "tc", "qdisc", "del", "dev", NET_IF, "root"], check=True)
-        print("[netem] cleared")
-    except Exception as e:
-        print("[netem] clear error (maybe none applied):", e)
-
-def run_wrapper(duration, reporting_interval, loss_prob, batch, outdir):
-    # writes a small wrapper and runs it
-    wrapper_body = f"""import sys, os
-sys.path.append(os.path.dirname(os.path.abspath(__file__)))
-from client import SensorClient
-import time, random
-DEVICE_ID = {random.randint(1000,9999)}
-REPORTING_INTERVAL = {reporting_interval}
-DURATION = {duration}
-LOSS_PROB = {loss_prob}
-BATCH = {batch}
-c = SensorClient(device_id=DEVICE_ID, reporting_interval=REPORTING_INTERVAL, batch_size=BATCH)
-start = time.time()
-while time.time()-start < DURATION:
-    if random.random() > LOSS_PROB:
-        c.send_data([round(random.uniform(20,30),2) for _ in range(BATCH)])
-    else:
-        print('[wrapper] simulated loss')
-    time.sleep(REPORTING_INTERVAL)
-c.running = False
-"""
-    with open(SCENARIO_WRAPPER, "w") as f:
-        f.write(wrapper_body)
-    try:
-        subprocess.run([PY, SCENARIO_WRAPPER], cwd=PROJECT_DIR, check=True)
-    finally:
-        try:
-            os.remove(SCENARIO_WRAPPER)
-        except:
-            pass
-
-def collect_outputs(outdir):
-    for fname in ["telemetry_log.csv", "telemetry_reordered.csv", "metrics.json"]:
-        src = os.path.join(PROJECT_DIR, fname)
-        if os.path.exists(src):
-            shutil.copy(src, os.path.join(outdir, fname))
-
-def run_scenario(name, duration=20, reporting_interval=1, loss_prob=0.0, batch=1, netem=None):
-    print(f"\n=== scenario: {name} ===")
+def delivery_stats(server_dirs, client, batch):
+    """Delivered share of DATA packets and what reliability cost, over all collectors."""
+    delivered = set()
+    nack_bytes = recovered = 0
+    for d in server_dirs:
+        with open(os.path.join(d, "telemetry_log.csv"), newline="") as f:
+            delivered.update((row["device_id"], row["seq"]) for row in csv.DictReader(f)
+                             if row["heartbeat_flag"] == "0")
+        with open(os.path.join(d, "metrics.json")) as mf:
+            m = json.load(mf)
+        nack_bytes += m["nack_bytes"]
+        recovered += m["recovered"]
+    sent = client.data_sent
+    return {"data_sent": sent, "delivered": len(delivered),
+            "delivered_fraction": len(delivered) / sent if sent else 0.0,
+            "retransmits": client.retransmits,
+            "retransmit_bytes": client.retransmits * (HEADER_SIZE + 4 * batch + (TAG_SIZE if client.auth else 0)),
+            "nack_bytes": nack_bytes, "recovered": recovered}
+
+def send_forged(port, secret, device_ids):
+    """Sends one unsigned, one wrong-secret and one spoofed packet; returns their device_ids."""
+    forged = random.sample(range(10000, 11000), 3)
+    packets = [
+        build_packet(forged[0], 0, DATA, [21.5]),
+        PacketAuth("not-" + secret).sign(forged[1], build_packet(forged[1], 0, DATA, [21.5])),
+        # a provisioned device signing for another device_id with its own key
+        PacketAuth.for_devices({forged[2]: derive_key(secret, device_ids[0])})
+            .sign(forged[2], build_packet(forged[2], 0, DATA, [21.5])),
+    ]
+    s = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+    for pkt in packets:
+        s.sendto(pkt, ("127.0.0.1", port))
+    s.close()
+    return forged
+
+def check_signed_run(outdir, device_ids, forged):
+    """Raises unless every signed device was logged and only the forged packets failed auth."""
+    with open(os.path.join(outdir, "metrics.json")) as mf:
+        failures = json.load(mf)["auth_failures"]
+    logged = logged_devices(outdir)
+    print(f"[Test] signed devices logged={len(logged & set(device_ids))}/{len(device_ids)} "
+          f"auth_failures={failures} forged logged={len(logged & set(forged))}", flush=True)
+    if failures != len(forged):
+        raise RuntimeError(f"auth_failures={failures}, expected {len(forged)} (one per forged packet)")
+    if logged & set(forged):
+        raise RuntimeError(f"forged packets were logged: {sorted(logged & set(forged))}")
+    if set(device_ids) - logged:
+        raise RuntimeError(f"signed devices never logged: {sorted(set(device_ids) - logged)}")
+
+def check_router_run(outdir, collector_dirs, device_ids, retransmits):
+    """Raises if a device was split across collectors or no NACK made it back."""
+    seen = [logged_devices(d) for d in collector_dirs]
+    split = set().union(*(a & b for i, a in enumerate(seen) for b in seen[i + 1:]))
+    missing = set(device_ids) - set().union(*seen)
+    with open(os.path.join(outdir, "router.log")) as lf:
+        summary = ROUTER_SUMMARY_RE.search(lf.read())
+    if not summary:
+        raise RuntimeError("router printed no summary")
+    relayed = int(summary.group(2))
+    print(f"[Test] per-collector devices={[len(s) for s in seen]} split={len(split)} "
+          f"missing={len(missing)} relayed={relayed} retransmits={retransmits}", flush=True)
+    if split or missing:
+        raise RuntimeError(f"devices split across collectors: {sorted(split)}, never logged: {sorted(missing)}")
+    if relayed == 0 or retransmits == 0:
+        raise RuntimeError(f"NACKs not relayed through the router (relayed={relayed}, retransmits={retransmits})")
+
+def run_scenario(name, duration=20, reporting_interval=1, loss_prob=0.0, batch=1,
+                 delay_ms=0, jitter_ms=0, speed=1.0, reliable=False, devices=1, collectors=0,
+                 auth_secret=None):
+    """
+    collectors > 0 puts that many server.py instances behind router.py.
+    auth_secret runs the server with --auth-secret and a fleet holding only its device keys.
+    """
+    print(f"=== scenario: {name} ===", flush=True)
     outdir = os.path.join(RESULTS_DIR, name.replace(" ", "_"))
     if os.path.exists(outdir):
         shutil.rmtree(outdir)
     os.makedirs(outdir, exist_ok=True)
 
-    server_proc = start_server()
-    time.sleep(0.5)
-
+    started = time.time()
+    server_args = ["--nack"] if reliable else []
+    if auth_secret:
+        server_args += ["--auth-secret", auth_secret]
+    collector_dirs = [os.path.join(outdir, f"c{i + 1}") for i in range(collectors)]
+    procs, router_proc = [], None
     try:
-        if netem:
-            apply_netem(netem)
-            time.sleep(0.2)
-
-        run_wrapper(duration, reporting_interval, loss_prob, batch, outdir)
+        if collectors:
+            ports = []
+            for d in collector_dirs:
+                os.makedirs(d)
+                proc, p = start_server(d, server_args)
+                procs.append(proc)
+                ports.append(p)
+            router_proc, port = start_router(outdir, ports)
+        else:
+            proc, port = start_server(outdir, server_args)
+            procs.append(proc)
+        device_ids = random.sample(range(1000, 10000), devices)
+        keys = {d: derive_key(auth_secret, d) for d in device_ids} if auth_secret else None
+        client = ImpairedClient(
+            device_ids, reporting_interval=reporting_interval,
+            batch_size=batch, server_port=port, speed=speed, reliable=reliable,
+            auth_keys=keys, loss_prob=loss_prob, delay_ms=delay_ms, jitter_ms=jitter_ms)
+        # in reliability mode, stay around for the server's last NACK rounds
+        client.run(duration=duration, linger=NACK_LINGER if reliable else 0.0)
+        if auth_secret:
+            forged = send_forged(port, auth_secret, device_ids)
+        time.sleep(SERVER_SETTLE)
     finally:
-        clear_netem()
-        stop_server(server_proc)
-        time.sleep(0.5)
-        collect_outputs(outdir)
-        with open(os.path.join(outdir, "notes.txt"), "w") as nf:
-            nf.write(json.dumps({"duration": duration, "reporting_interval": reporting_interval, "loss_prob": loss_prob, "batch": batch}))
-        print(f"scenario '{name}' done, results in {outdir}")
+        # router first, so its summary covers everything the collectors saw
+        stop_server(router_proc)
+        for proc in procs:
+            stop_server(proc)
+
+    stats = delivery_stats(collector_dirs or [outdir], client, batch)
+    with open(os.path.join(outdir, "notes.txt"), "w") as nf:
+        nf.write(json.dumps({"duration": duration, "reporting_interval": reporting_interval,
+                             "loss_prob": loss_prob, "batch": batch, "delay_ms": delay_ms,
+                             "jitter_ms": jitter_ms, "speed": speed, "reliable": reliable,
+                             "devices": devices, "collectors": collectors, "signed": bool(auth_secret),
+                             "results": stats}))
+    print(f"[Test] {name}: delivered {stats['delivered']}/{stats['data_sent']} "
+          f"({stats['delivered_fraction']:.2%}) retransmits={stats['retransmits']} "
+          f"retransmit_bytes={stats['retransmit_bytes']} nack_bytes={stats['nack_bytes']} "
+          f"recovered={stats['recovered']}", flush=True)
+    if reliable and loss_prob > 0 and (stats["retransmits"] == 0 or stats["recovered"] == 0):
+        raise RuntimeError(f"no loss repaired (retransmits={stats['retransmits']}, recovered={stats['recovered']})")
+    if auth_secret:
+        check_signed_run(outdir, device_ids, forged)
+    if collectors:
+        check_router_run(outdir, collector_dirs, device_ids, client.retransmits)
+    return name, outdir, time.time() - started
+
+def run_all(scenarios, workers=None, speed=None):
+    """Runs scenarios concurrently; speed, if given, overrides every scenario's speed."""
+    jobs = [dict(sc, speed=speed) if speed else sc for sc in scenarios]
+    failed = 0
+    with ProcessPoolExecutor(max_workers=workers or len(jobs)) as pool:
+        futures = {pool.submit(run_scenario, **job): job["name"] for job in jobs}
+        for fut in as_completed(futures):
+            try:
+                name, outdir, elapsed = fut.result()
+                print(f"scenario '{name}' done in {elapsed:.1f}s, results in {outdir}", flush=True)
+            except Exception as e:
+                failed += 1
+                print(f"scenario '{futures[fut]}' failed: {e}", flush=True)
+    return failed
 
 if __name__ == "__main__":
-    # baseline
-    run_scenario("baseline_1s", duration=20, reporting_interval=1, loss_prob=0.0, batch=1)
-    # loss 5%
-    run_scenario("loss_5pct", duration=20, reporting_interval=1, loss_prob=0.05, batch=1)
-    # delay + jitter 100ms +-10ms (netem)
-    run_scenario("delay_100ms_10ms", duration=20, reporting_interval=1, loss_prob=0.0, batch=1, netem="delay 100ms 10ms")
-    # different intervals
-    run_scenario("interval_5s", duration=60, reporting_interval=5, loss_prob=0.0, batch=1)
-    run_scenario("interval_30s", duration=120, reporting_interval=30, loss_prob=0.0, batch=1)
-    # batching experiments
-    run_scenario("batch_5", duration=30, reporting_interval=1, loss_prob=0.0, batch=5)
-    run_scenario("batch_10", duration=30, reporting_interval=1, loss_prob=0.0, batch=10)
-    print("All scenarios finished.")
+    parser = argparse.ArgumentParser(description="Run Phase-2 scenarios in parallel")
+    parser.add_argument("--workers", type=int, default=None, help="Parallel scenarios (default: all)")
+    parser.add_argument("--speed", type=float, default=None, help="Virtual clock speed for every scenario")
+    parser.add_argument("--only", nargs="*", default=None, help="Scenario names to run")
+    args = parser.parse_args()
+
+    scenarios = [sc for sc in SCENARIOS if not args.only or sc["name"] in args.only]
+    started = time.time()
+    failed = run_all(scenarios, workers=args.workers, speed=args.speed)
+    print(f"All scenarios finished in {time.time() - started:.1f}s.")
+    sys.exit(1 if failed else 0)